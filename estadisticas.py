@@ -0,0 +1,76 @@
+# Cálculo de los incrementos y de la deriva de los contadores de estadísticas.
+# No depende de MongoDB ni de FastAPI para poder probarse por separado.
+from datetime import datetime, timedelta
+from typing import Optional
+
+
+# Genera los incrementos de los contadores asociados a un préstamo activo
+def incrementos_prestamo(lector_id: int, libro_id: int, autor_id: Optional[int], bibliotecario_id: int, signo: int):
+    incrementos = {
+        "prestamos_activos": signo,
+        f"prestamos_por_lector.{lector_id}": signo,
+        f"prestamos_por_libro.{libro_id}": signo,
+        f"carga_bibliotecarios.{bibliotecario_id}": signo
+    }
+    # Si el libro ya no existe, el préstamo no se atribuye a ningún autor
+    if autor_id is not None:
+        incrementos[f"prestamos_por_autor.{autor_id}"] = signo
+    return incrementos
+
+# Genera los incrementos al mover un préstamo de lector, libro o bibliotecario.
+# Cada argumento es una tupla (lector_id, libro_id, autor_id, bibliotecario_id).
+def incrementos_cambio_prestamo(anterior: tuple, nuevo: tuple):
+    incrementos = incrementos_prestamo(*anterior, -1)
+    for campo, valor in incrementos_prestamo(*nuevo, 1).items():
+        incrementos[campo] = incrementos.get(campo, 0) + valor
+    return sin_ceros(incrementos)
+
+# Genera los incrementos al eliminar un libro con `activos` préstamos activos
+def incrementos_eliminar_libro(libro: dict, activos: int):
+    incrementos = {
+        "libros_totales": -1,
+        # Un libro prestado ya no cuenta como disponible
+        "libros_disponibles": -1 if libro["inventario"] else 0
+    }
+    # Los préstamos activos de un libro eliminado ya no se atribuyen a su autor
+    if activos:
+        incrementos[f"prestamos_por_autor.{libro['autor_id']}"] = -activos
+    return sin_ceros(incrementos)
+
+# Elimina los contadores en cero para no reportar lectores, libros, etc. sin préstamos
+def sin_ceros(contadores: dict):
+    return {k: v for k, v in contadores.items() if v != 0}
+
+# Compara los contadores incrementales con los recalculados y devuelve las diferencias
+def calcular_deriva(actuales: dict, recalculadas: dict):
+    deriva = {}
+    for campo, valor in recalculadas.items():
+        if isinstance(valor, dict):
+            anteriores = sin_ceros(actuales.get(campo, {}))
+            for clave in set(anteriores) | set(valor):
+                if anteriores.get(clave, 0) != valor.get(clave, 0):
+                    deriva[f"{campo}.{clave}"] = {
+                        "contador": anteriores.get(clave, 0),
+                        "real": valor.get(clave, 0)
+                    }
+        elif actuales.get(campo, 0) != valor:
+            deriva[campo] = {"contador": actuales.get(campo, 0), "real": valor}
+    return deriva
+
+# Conserva solo la deriva que se repite con la misma diferencia en dos mediciones.
+# Una diferencia que desaparece o cambia se debe a operaciones en curso.
+def deriva_persistente(primera: dict, segunda: dict):
+    return {
+        campo: valores
+        for campo, valores in segunda.items()
+        if campo in primera
+        and primera[campo]["real"] - primera[campo]["contador"] == valores["real"] - valores["contador"]
+    }
+
+# Convierte la deriva en incrementos que corrigen los contadores
+def correcciones_deriva(deriva: dict):
+    return {campo: valores["real"] - valores["contador"] for campo, valores in deriva.items()}
+
+# Indica si la última reconciliación ocurrió hace menos de `intervalo` segundos
+def reconciliacion_reciente(ultima: Optional[datetime], ahora: datetime, intervalo: int):
+    return ultima is not None and ultima > ahora - timedelta(seconds=intervalo)
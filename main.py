@@ -5,9 +5,26 @@ from pydantic import BaseModel
 from motor import motor_asyncio
 import boto3
 from botocore.exceptions import NoCredentialsError
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, suppress
 import uuid
+import asyncio
+import logging
+import os
 from typing import Optional
+from estadisticas import (
+    incrementos_prestamo,
+    incrementos_cambio_prestamo,
+    incrementos_eliminar_libro,
+    sin_ceros,
+    calcular_deriva,
+    deriva_persistente,
+    correcciones_deriva,
+    reconciliacion_reciente
+)
+
+logger = logging.getLogger(__name__)
 
 
 # Configurar la conexión con MongoDB
@@ -26,9 +43,34 @@ libros_collection = db["Libro"]
 lectores_collection = db["Lector"]
 bibliotecarios_collection = db["Bibliotecario"]
 autores_collection = db["Autor"]
+estadisticas_collection = db["Estadisticas"]
+
+# Documento único donde se guardan los contadores de estadísticas
+ESTADISTICAS_ID = "biblioteca"
+# Cada cuántos segundos se recalculan los contadores desde cero
+RECONCILIACION_INTERVALO = 3600
+# Documento que funciona como bloqueo para que solo un proceso reconcilie a la vez
+BLOQUEO_ID = "reconciliacion"
+# Segundos que dura el bloqueo si el proceso que lo tiene termina sin liberarlo
+BLOQUEO_DURACION = 300
+# Identificador de este proceso dentro del bloqueo
+PROCESO_ID = f"{os.getpid()}-{uuid.uuid4()}"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Índices usados por la reconciliación y por el conteo de préstamos de un libro
+    await libros_collection.create_index("id")
+    await prestamos_collection.create_index("libro_id")
+    # La primera reconciliación inicializa los contadores con los datos existentes
+    reconciliacion = asyncio.create_task(reconciliacion_periodica())
+    yield
+    # Esperar a la tarea para que libere el bloqueo antes de cerrar la conexión
+    reconciliacion.cancel()
+    with suppress(asyncio.CancelledError):
+        await reconciliacion
 
 # Objeto para interactuar con la API
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Ruta de la carpeta donde se almacenarán las imágenes
 IMAGES_DIR = Path("img")
@@ -153,11 +195,23 @@ async def create_prestamo(file: UploadFile = File(...), lector_id: int = 0, libr
     #print(nuevo_prestamo)
     # Insertar el nuevo préstamo en la colección
     await prestamos_collection.insert_one(nuevo_prestamo)
-    # Actualizar el inventario del libro a False
-    await libros_collection.update_one(
+    # Actualizar el inventario del libro a False, conservando su estado anterior
+    libro = await libros_collection.find_one_and_update(
         {"id": libro_id},
         {"$set": {"inventario": False}}
     )
+    # Actualizar los contadores de estadísticas
+    incrementos = incrementos_prestamo(
+        lector_id,
+        libro_id,
+        libro["autor_id"] if libro else None,
+        bibliotecario_id,
+        1
+    )
+    # Solo la petición que cambió el inventario descuenta el libro disponible
+    if libro and libro["inventario"]:
+        incrementos["libros_disponibles"] = -1
+    await actualizar_estadisticas(incrementos)
     # Devolver el nuevo préstamo con las fechas en formato ISO 8601
     prestamo_dict = {
         "id": nuevo_prestamo["id"],  # Asegúrate de que se devuelve el nuevo id
@@ -218,14 +272,33 @@ async def update_prestamo(
         update_data["foto_credencial"] = imagen_url  # Actualizar el campo imagen_portada con la nueva URL
 
    
-     # Actualizar el prestamo en la base de datos
-    result = await prestamos_collection.update_one(
+     # Actualizar el prestamo en la base de datos, conservando la versión anterior
+    prestamo_anterior = await prestamos_collection.find_one_and_update(
         {"id": id},
         {"$set": update_data}
     )
 
     # Verificar si se realizó alguna actualización
-    if result.matched_count == 1:
+    if prestamo_anterior:
+        # Mover los contadores del lector, libro, autor y bibliotecario anteriores a los nuevos
+        libro_anterior = await libros_collection.find_one({"id": prestamo_anterior["libro_id"]})
+        libro_nuevo = await libros_collection.find_one({"id": update_data.get("libro_id", prestamo_anterior["libro_id"])})
+        incrementos = incrementos_cambio_prestamo(
+            (
+                prestamo_anterior["lector_id"],
+                prestamo_anterior["libro_id"],
+                libro_anterior["autor_id"] if libro_anterior else None,
+                prestamo_anterior["bibliotecario_id"]
+            ),
+            (
+                update_data.get("lector_id", prestamo_anterior["lector_id"]),
+                update_data.get("libro_id", prestamo_anterior["libro_id"]),
+                libro_nuevo["autor_id"] if libro_nuevo else None,
+                update_data.get("bibliotecario_id", prestamo_anterior["bibliotecario_id"])
+            )
+        )
+        await actualizar_estadisticas(incrementos)
+
         # Si el préstamo fue actualizado correctamente, devolver la nueva información
         updated_prestamo = await prestamos_collection.find_one({"id": id})
         if updated_prestamo:
@@ -246,11 +319,23 @@ async def delete_prestamo(id: int):
     result = await prestamos_collection.delete_one({"id": id})
     
     if result.deleted_count == 1:
-        # Actualizar el inventario del libro a True
-        await libros_collection.update_one(
+        # Actualizar el inventario del libro a True, conservando su estado anterior
+        libro = await libros_collection.find_one_and_update(
             {"id": prestamo["libro_id"]},
             {"$set": {"inventario": True}}
         )
+
+        # Actualizar los contadores de estadísticas
+        incrementos = incrementos_prestamo(
+            prestamo["lector_id"],
+            prestamo["libro_id"],
+            libro["autor_id"] if libro else None,
+            prestamo["bibliotecario_id"],
+            -1
+        )
+        if libro and not libro["inventario"]:
+            incrementos["libros_disponibles"] = 1
+        await actualizar_estadisticas(incrementos)
         
         return {
             "message": "El préstamo se eliminó correctamente"
@@ -322,7 +407,12 @@ async def create_libro(file: UploadFile = File(...), titulo: str = "", autor_id:
         "inventario": inventario
     }
     # Insertar libro en la base de datos
-    libros_collection.insert_one(libro_data)
+    await libros_collection.insert_one(libro_data)
+    # Actualizar los contadores de estadísticas
+    await actualizar_estadisticas({
+        "libros_totales": 1,
+        "libros_disponibles": 1 if inventario else 0
+    })
     return libro_data
 
 # Ruta para actualizar un libro con la opción de subir una nueva imagen
@@ -361,13 +451,28 @@ async def update_libro(
 
         update_data["imagen_portada"] = imagen_url  # Actualizar el campo imagen_portada con la nueva URL
 
-    # Actualizar el libro en la base de datos
-    result = await libros_collection.update_one(
+    # Contar los préstamos activos del libro antes de cambiar su autor
+    if "autor_id" in update_data:
+        activos = await prestamos_collection.count_documents({"libro_id": libro_id})
+
+    # Actualizar el libro en la base de datos, conservando la versión anterior
+    libro_anterior = await libros_collection.find_one_and_update(
         {"id": libro_id},
         {"$set": update_data}
     )
     
-    if result.matched_count == 1:
+    if libro_anterior:
+        # Actualizar los contadores de estadísticas
+        incrementos = {}
+        if "inventario" in update_data and update_data["inventario"] != libro_anterior["inventario"]:
+            incrementos["libros_disponibles"] = 1 if update_data["inventario"] else -1
+        if "autor_id" in update_data and update_data["autor_id"] != libro_anterior["autor_id"]:
+            # Los préstamos activos del libro pasan al nuevo autor
+            if activos:
+                incrementos[f"prestamos_por_autor.{libro_anterior['autor_id']}"] = -activos
+                incrementos[f"prestamos_por_autor.{update_data['autor_id']}"] = activos
+        await actualizar_estadisticas(incrementos)
+
         # Recuperar el libro actualizado
         libro_actualizado = await libros_collection.find_one({"id": libro_id})
         if libro_actualizado:
@@ -380,8 +485,12 @@ async def update_libro(
 # Ruta para eliminar un libro (Delete)
 @app.delete("/libro/{libro_id}")
 async def delete_libro(libro_id: int):
-    result = await libros_collection.delete_one({"id": libro_id})
-    if result.deleted_count == 1:
+    # Contar los préstamos activos del libro antes de eliminarlo
+    activos = await prestamos_collection.count_documents({"libro_id": libro_id})
+    libro = await libros_collection.find_one_and_delete({"id": libro_id})
+    if libro:
+        # Actualizar los contadores de estadísticas
+        await actualizar_estadisticas(incrementos_eliminar_libro(libro, activos))
         return {"message": "Libro eliminado exitosamente"}
     raise HTTPException(status_code=404, detail="Libro no encontrado")
 
@@ -668,3 +777,163 @@ async def delete_autor(id: int):
     raise HTTPException(status_code=404, detail="El autor no se encontró")
 
 
+
+# ---------------------------- Estadisticas ---------------------------
+
+# Aplica los incrementos sobre el documento de estadísticas
+async def actualizar_estadisticas(incrementos: dict):
+    if incrementos:
+        await estadisticas_collection.update_one(
+            {"_id": ESTADISTICAS_ID},
+            {"$inc": incrementos},
+            upsert=True
+        )
+
+# Recalcula todos los contadores desde cero con pipelines de agregación
+async def calcular_estadisticas():
+    def agrupar_por(campo: str):
+        return [{"$group": {"_id": f"${campo}", "total": {"$sum": 1}}}]
+
+    prestamos = await prestamos_collection.aggregate([
+        {"$facet": {
+            "prestamos_activos": [{"$count": "total"}],
+            "prestamos_por_lector": agrupar_por("lector_id"),
+            "prestamos_por_libro": agrupar_por("libro_id"),
+            "carga_bibliotecarios": agrupar_por("bibliotecario_id"),
+            # Usa el índice sobre Libro.id creado al iniciar la API
+            "prestamos_por_autor": [
+                {"$lookup": {
+                    "from": libros_collection.name,
+                    "localField": "libro_id",
+                    "foreignField": "id",
+                    "as": "libro"
+                }},
+                {"$unwind": "$libro"},
+                {"$group": {"_id": "$libro.autor_id", "total": {"$sum": 1}}}
+            ]
+        }}
+    ]).to_list(None)
+    libros = await libros_collection.aggregate([
+        {"$group": {
+            "_id": None,
+            "libros_totales": {"$sum": 1},
+            "libros_disponibles": {"$sum": {"$cond": ["$inventario", 1, 0]}}
+        }}
+    ]).to_list(None)
+
+    facetas = prestamos[0]
+    activos = facetas["prestamos_activos"]
+    estadisticas = {
+        "prestamos_activos": activos[0]["total"] if activos else 0,
+        "libros_totales": libros[0]["libros_totales"] if libros else 0,
+        "libros_disponibles": libros[0]["libros_disponibles"] if libros else 0
+    }
+    for campo in ("prestamos_por_lector", "prestamos_por_libro", "prestamos_por_autor", "carga_bibliotecarios"):
+        estadisticas[campo] = {str(grupo["_id"]): grupo["total"] for grupo in facetas[campo]}
+    return estadisticas
+
+# Mide la deriva entre los contadores actuales y los recalculados
+async def medir_deriva():
+    actuales = await estadisticas_collection.find_one({"_id": ESTADISTICAS_ID}) or {}
+    return actuales, calcular_deriva(actuales, await calcular_estadisticas())
+
+# Indica si ya se reconcilió durante el intervalo actual leyendo solo la fecha
+async def reconciliada_recientemente():
+    estadisticas = await estadisticas_collection.find_one(
+        {"_id": ESTADISTICAS_ID},
+        {"ultima_reconciliacion": 1}
+    ) or {}
+    return reconciliacion_reciente(
+        estadisticas.get("ultima_reconciliacion"),
+        datetime.now(),
+        RECONCILIACION_INTERVALO
+    )
+
+# Intenta tomar el bloqueo de reconciliación; falla si otro proceso lo tiene vigente
+async def adquirir_bloqueo():
+    ahora = datetime.now()
+    try:
+        await estadisticas_collection.update_one(
+            {"_id": BLOQUEO_ID, "expira": {"$lt": ahora}},
+            {"$set": {"proceso": PROCESO_ID, "expira": ahora + timedelta(seconds=BLOQUEO_DURACION)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # El documento existe y no ha expirado: otro proceso está reconciliando
+        return False
+
+async def liberar_bloqueo():
+    await estadisticas_collection.delete_one({"_id": BLOQUEO_ID, "proceso": PROCESO_ID})
+
+# Corrige con $inc solo la deriva que se repite en dos mediciones seguidas,
+# para no pisar los incrementos concurrentes ni reportar operaciones en curso.
+# Devuelve None si no se reconcilió porque otro proceso tiene el bloqueo o,
+# sin `forzar`, porque ya se reconcilió durante el intervalo actual.
+async def reconciliar_estadisticas(forzar: bool = False):
+    # Sin `forzar`, omitir sin tomar el bloqueo ni recorrer las colecciones
+    if not forzar and await reconciliada_recientemente():
+        return None
+    if not await adquirir_bloqueo():
+        return None
+    try:
+        # Volver a comprobar por si otro proceso reconcilió mientras se tomaba el bloqueo
+        if not forzar and await reconciliada_recientemente():
+            return None
+        _, primera = await medir_deriva()
+
+        deriva = {}
+        if primera:
+            _, segunda = await medir_deriva()
+            deriva = deriva_persistente(primera, segunda)
+
+        cambios = {"$set": {
+            "ultima_reconciliacion": datetime.now(),
+            "deriva": [{"campo": campo, **valores} for campo, valores in deriva.items()]
+        }}
+        if deriva:
+            cambios["$inc"] = correcciones_deriva(deriva)
+            logger.warning("Deriva en estadísticas corregida: %s", deriva)
+        await estadisticas_collection.update_one({"_id": ESTADISTICAS_ID}, cambios, upsert=True)
+        return cambios["$set"]["deriva"]
+    finally:
+        await liberar_bloqueo()
+
+# Tarea periódica de reconciliación; cada proceso la ejecuta, pero el bloqueo
+# y la fecha de la última reconciliación hacen que solo uno reconcilie por intervalo
+async def reconciliacion_periodica():
+    while True:
+        try:
+            await reconciliar_estadisticas()
+        except Exception:
+            logger.exception("Error al reconciliar estadísticas")
+        await asyncio.sleep(RECONCILIACION_INTERVALO)
+
+@app.get("/estadisticas")
+async def get_estadisticas():
+    # Lectura de un único documento, sin recorrer Prestamo ni Libro
+    estadisticas = await estadisticas_collection.find_one({"_id": ESTADISTICAS_ID}) or {}
+    libros_totales = estadisticas.get("libros_totales", 0)
+    libros_disponibles = estadisticas.get("libros_disponibles", 0)
+    return {
+        "prestamos_activos": estadisticas.get("prestamos_activos", 0),
+        "prestamos_por_lector": sin_ceros(estadisticas.get("prestamos_por_lector", {})),
+        "prestamos_por_libro": sin_ceros(estadisticas.get("prestamos_por_libro", {})),
+        "prestamos_por_autor": sin_ceros(estadisticas.get("prestamos_por_autor", {})),
+        "carga_bibliotecarios": sin_ceros(estadisticas.get("carga_bibliotecarios", {})),
+        "libros_totales": libros_totales,
+        "libros_disponibles": libros_disponibles,
+        "disponibilidad": libros_disponibles / libros_totales if libros_totales else 0.0,
+        "ultima_reconciliacion": estadisticas.get("ultima_reconciliacion"),
+        "deriva": estadisticas.get("deriva", [])
+    }
+
+@app.post("/estadisticas/reconciliar")
+async def post_reconciliar_estadisticas():
+    deriva = await reconciliar_estadisticas(forzar=True)
+    if deriva is None:
+        raise HTTPException(status_code=409, detail="Ya hay una reconciliación en curso")
+    return {
+        "message": "Estadísticas reconciliadas",
+        "deriva": deriva
+    }
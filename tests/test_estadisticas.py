@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+
+from estadisticas import (
+    incrementos_prestamo,
+    incrementos_cambio_prestamo,
+    incrementos_eliminar_libro,
+    calcular_deriva,
+    deriva_persistente,
+    correcciones_deriva,
+    reconciliacion_reciente
+)
+
+
+def test_incrementos_prestamo_nuevo():
+    assert incrementos_prestamo(1, 2, 3, 4, 1) == {
+        "prestamos_activos": 1,
+        "prestamos_por_lector.1": 1,
+        "prestamos_por_libro.2": 1,
+        "prestamos_por_autor.3": 1,
+        "carga_bibliotecarios.4": 1
+    }
+
+
+def test_incrementos_prestamo_sin_autor():
+    incrementos = incrementos_prestamo(1, 2, None, 4, -1)
+    assert incrementos["prestamos_por_libro.2"] == -1
+    assert not any(campo.startswith("prestamos_por_autor") for campo in incrementos)
+
+
+def test_cambio_prestamo_a_otro_libro():
+    # Mismo lector y bibliotecario; el libro 2 (autor 3) pasa al libro 5 (autor 6)
+    assert incrementos_cambio_prestamo((1, 2, 3, 4), (1, 5, 6, 4)) == {
+        "prestamos_por_libro.2": -1,
+        "prestamos_por_libro.5": 1,
+        "prestamos_por_autor.3": -1,
+        "prestamos_por_autor.6": 1
+    }
+
+
+def test_cambio_prestamo_mismo_autor():
+    assert incrementos_cambio_prestamo((1, 2, 3, 4), (1, 5, 3, 4)) == {
+        "prestamos_por_libro.2": -1,
+        "prestamos_por_libro.5": 1
+    }
+
+
+def test_cambio_prestamo_de_lector_y_bibliotecario():
+    assert incrementos_cambio_prestamo((1, 2, 3, 4), (7, 2, 3, 8)) == {
+        "prestamos_por_lector.1": -1,
+        "prestamos_por_lector.7": 1,
+        "carga_bibliotecarios.4": -1,
+        "carga_bibliotecarios.8": 1
+    }
+
+
+def test_cambio_prestamo_sin_cambios():
+    assert incrementos_cambio_prestamo((1, 2, 3, 4), (1, 2, 3, 4)) == {}
+
+
+def test_eliminar_libro_disponible():
+    assert incrementos_eliminar_libro({"autor_id": 3, "inventario": True}, 0) == {
+        "libros_totales": -1,
+        "libros_disponibles": -1
+    }
+
+
+def test_eliminar_libro_prestado():
+    # Un libro prestado no se contaba como disponible
+    assert incrementos_eliminar_libro({"autor_id": 3, "inventario": False}, 1) == {
+        "libros_totales": -1,
+        "prestamos_por_autor.3": -1
+    }
+
+
+def test_deriva_sin_diferencias():
+    actuales = {
+        "prestamos_activos": 2,
+        "prestamos_por_lector": {"1": 2, "9": 0},
+        "libros_totales": 5
+    }
+    recalculadas = {
+        "prestamos_activos": 2,
+        "prestamos_por_lector": {"1": 2},
+        "libros_totales": 5
+    }
+    assert calcular_deriva(actuales, recalculadas) == {}
+
+
+def test_deriva_con_diferencias():
+    actuales = {"prestamos_activos": 3, "prestamos_por_lector": {"1": 3}}
+    recalculadas = {
+        "prestamos_activos": 2,
+        "prestamos_por_lector": {"1": 1, "2": 1},
+        "libros_totales": 4
+    }
+    deriva = calcular_deriva(actuales, recalculadas)
+    assert deriva == {
+        "prestamos_activos": {"contador": 3, "real": 2},
+        "prestamos_por_lector.1": {"contador": 3, "real": 1},
+        "prestamos_por_lector.2": {"contador": 0, "real": 1},
+        "libros_totales": {"contador": 0, "real": 4}
+    }
+    assert correcciones_deriva(deriva) == {
+        "prestamos_activos": -1,
+        "prestamos_por_lector.1": -2,
+        "prestamos_por_lector.2": 1,
+        "libros_totales": 4
+    }
+
+
+def test_deriva_persistente_ignora_operaciones_en_curso():
+    primera = {
+        "prestamos_activos": {"contador": 3, "real": 2},
+        "prestamos_por_libro.1": {"contador": 0, "real": 1}
+    }
+    # En la segunda medición el préstamo en curso ya se contó y la deriva real se mantiene
+    segunda = {
+        "prestamos_activos": {"contador": 4, "real": 3}
+    }
+    assert deriva_persistente(primera, segunda) == {
+        "prestamos_activos": {"contador": 4, "real": 3}
+    }
+
+
+def test_deriva_persistente_descarta_diferencia_que_cambia():
+    primera = {"prestamos_activos": {"contador": 3, "real": 2}}
+    segunda = {"prestamos_activos": {"contador": 3, "real": 4}}
+    assert deriva_persistente(primera, segunda) == {}
+
+
+def test_reconciliacion_reciente_omite_dentro_del_intervalo():
+    ahora = datetime(2024, 1, 1, 12, 0)
+    assert reconciliacion_reciente(ahora - timedelta(minutes=10), ahora, 3600)
+
+
+def test_reconciliacion_reciente_vencida_o_inexistente():
+    ahora = datetime(2024, 1, 1, 12, 0)
+    assert not reconciliacion_reciente(ahora - timedelta(hours=2), ahora, 3600)
+    assert not reconciliacion_reciente(None, ahora, 3600)